@@ -1,8 +1,24 @@
 from __future__ import annotations
-from collections import defaultdict
+from collections import deque
 from collections.abc import Hashable, Iterable
+from sys import intern
 from . import grammar
 
+try:
+    import graphviz as _graphviz
+except ImportError:  # graphviz is only needed by FA.draw()
+    _graphviz = None
+
+
+#: Name of the final state that NFAs built from a grammar reach through rules of the form A -> a.
+EPSILON = intern("ε")
+
+
+def intern_symbol(x: Hashable) -> Hashable:
+    '''Intern string symbols, so that equal strings are the same object,
+    which makes comparing them a pointer check. Other symbols are returned as they are.'''
+    return intern(x) if type(x) is str else x
+
 class FA:
     '''
     A `formal automaton <https://en.wikipedia.org/wiki/Finite-state_machine#Mathematical_model>`_
@@ -13,36 +29,69 @@ class FA:
     :param s0: initial state
     :param d: the state-transition function
     :param F: set of final states
+
+    ``S``, ``A`` and ``F`` are stored as frozensets, and ``d`` is copied into a new dictionary
+    with new sets of states, so later changes to the arguments don't affect the FA.
+
+    Results derived from the transition function (e.g. :meth:`is_deterministic`) are cached
+    on the object until ``d`` is replaced. Code that modifies ``d`` in place
+    must reset them afterwards by calling :meth:`invalidate_caches`.
     '''
 
-    def __init__(self, S: set[Hashable], A: set[Hashable], s0: Hashable,
-                 d: dict[tuple[set[Hashable], Hashable], set[Hashable]], F: set[Hashable]):
-        self.S = S
-        self.A = A
-        self.s0 = s0
-        self.d = d
-        self.F = F
+    def __init__(self, S: Iterable[Hashable], A: Iterable[Hashable], s0: Hashable,
+                 d: dict[tuple[set[Hashable], Hashable], set[Hashable]], F: Iterable[Hashable]):
+        self.S = frozenset(intern_symbol(s) for s in S)
+        self.A = frozenset(intern_symbol(a) for a in A)
+        self.s0 = intern_symbol(s0)
+        self.d = {(intern_symbol(s), intern_symbol(a)): {intern_symbol(x) for x in v}
+                  for (s, a), v in d.items()}
+        self.F = frozenset(intern_symbol(s) for s in F)
+
+
+    @property
+    def d(self) -> dict[tuple[set[Hashable], Hashable], set[Hashable]]:
+        return self._d
+
+
+    @d.setter
+    def d(self, d):
+        self._d = d
+        self.invalidate_caches()
+
+
+    def invalidate_caches(self):
+        '''Drop the results cached from the transition function.
+        Must be called after modifying ``d`` in place. The other components
+        don't affect the caches and can be reassigned freely.'''
+        self._is_det = None
+        self._tables = None
 
 
     def __repr__(self):
-        return ', '.join([str(x) for x in [self.S, self.A, self.s0, self.d, self.F]])
+        return f"{self.S}, {self.A}, {self.s0}, {self.d}, {self.F}"
 
 
     def __eq__(self, other):
 
-        if isinstance(other, FA):
-            return (self.S == other.S and
-                    self.A == other.A and
-                    self.s0 == other.s0 and
-                    self.d == other.d and
-                    self.F == other.F)
+        if not isinstance(other, FA):
+            return NotImplemented
+        # frozensets cache their hash, so this rejects most unequal FAs cheaply
+        if hash(self.S) != hash(other.S):
+            return False
+        return (self.S == other.S and
+                self.A == other.A and
+                self.s0 == other.s0 and
+                self.d == other.d and
+                self.F == other.F)
 
 
     def is_deterministic(self) -> bool:
         '''See what determinism means on `wikipedia <https://en.wikipedia.org/wiki/Nondeterministic_finite_automaton#>`_.
 
         :returns: True if the FA is deterministic, otherwise False.'''
-        return all([len(l) == 1 for l in self.d.values()])
+        if self._is_det is None:
+            self._is_det = all(len(l) == 1 for l in self.d.values())
+        return self._is_det
 
 
     def verify(self, w: Iterable[Hashable]) -> bool:
@@ -53,13 +102,63 @@ class FA:
         '''
 
         assert self.is_deterministic()
-        s = self.s0
+        return self._walk(self._build_tables(), w)
+
+
+    def verify_many(self, words: Iterable[Iterable[Hashable]]) -> list[bool]:
+        '''Like :meth:`verify`, but for many strings at once,
+        checking the automaton and looking up its transition table only once.
+
+        :returns: A list with True for every accepted string and False for every rejected one.
+        '''
+
+        assert self.is_deterministic()
+        tables = self._build_tables()
+        return [self._walk(tables, w) for w in words]
+
+
+    def _walk(self, tables, w: Iterable[Hashable]) -> bool:
+        # Follow the string `w` from the initial state through the tables of _build_tables()
+        # and tell whether it ends in a final state.
+        state_to_id, states, sym_to_id, T = tables
+        s = state_to_id.get(self.s0)  # None if no transitions leave the initial state
         for l in w:
-            s2 = self.d.get((s, l))
-            if not s2:
+            i = sym_to_id.get(l)
+            if s is None or i is None:  # no transition, or symbol not in the alphabet
+                return False
+            s = T[s][i]
+            if s < 0:
                 return False
-            s = next(iter(s2))
-        return s in self.F
+        return (self.s0 if s is None else states[s]) in self.F
+
+
+    def _build_tables(self):
+        '''Build (and cache) a dense transition table of the deterministic FA.
+
+        The states and symbols used by the transitions are numbered, so that
+        ``T[state_id][symbol_id]`` is the id of the next state, or -1 if there is no transition,
+        and ``states[state_id]`` is the state itself.
+        The tables are built from ``d`` alone and rebuilt after it is replaced
+        or :meth:`invalidate_caches` is called,
+        the initial and final states are looked up on the FA by :meth:`_walk`.
+        '''
+        if self._tables is not None:
+            return self._tables
+
+        state_to_id = {}
+        sym_to_id = {}
+        for (s, a), v in self.d.items():
+            for x in (s, *v):
+                state_to_id.setdefault(x, len(state_to_id))
+            sym_to_id.setdefault(a, len(sym_to_id))
+        states = list(state_to_id)
+
+        T = [[-1] * len(sym_to_id) for _ in range(len(state_to_id))]
+        for (s, a), v in self.d.items():
+            T[state_to_id[s]][sym_to_id[a]] = state_to_id[next(iter(v))]
+
+        self._tables = state_to_id, states, sym_to_id, T
+        return self._tables
 
 
     def to_grammar(self) -> grammar.Grammar:
@@ -68,19 +167,21 @@ class FA:
         :returns: a strictly regular grammar corresponding to the current FA.
         '''
 
-        VT = {k[1] for k in self.d.keys()}
-        P = defaultdict(set)
+        VT = set()
+        P = {}
 
-        for k, v in self.d.items():
-            P[k[0],] |= {(k[1], s) if s != "ε" else (k[1],) for s in v}
+        for (h, a), v in self.d.items():
+            VT.add(a)
+            rights = P.setdefault((h,), set())
+            for s in v:
+                rights.add((a, s) if s != EPSILON else (a,))
 
         for s in self.F:
-            if s == "ε":
+            if s == EPSILON:
                 continue
-            P[s,] |= {tuple()}
-        P = dict(P)
+            P.setdefault((s,), set()).add(())
 
-        return grammar.Grammar(VN = self.S - {"ε"}, VT = VT, P = P, S = self.s0)
+        return grammar.Grammar(VN = self.S - {EPSILON}, VT = VT, P = P, S = self.s0)
 
 
     def to_DFA(self) -> FA:
@@ -111,28 +212,71 @@ class FA:
                 F = {{'A'}, {'A', 'B'}, {'ε'}})
         '''
 
-        def move(T: set[Hashable], a: Hashable):
-            '''Returns the set of states reachable from any state in T via symbol a'''
-            return {s for S in T if (u := self.d.get((S, a))) for s in u}
+        # Internally, a set of NFA states is a bitmask with bit i set for state states[i]
+
+        def move(T: int, t: list[int]) -> int:
+            '''Returns the set of states reachable from any state in T via the symbol whose
+            successor masks are t'''
+            U = 0
+            while T:
+                b = T & -T  # lowest set bit
+                U |= t[b.bit_length() - 1]
+                T ^= b
+            return U
+
+        def decode(T: int) -> frozenset[Hashable]:
+            if T not in dsets:
+                dsets[T] = frozenset(s for i, s in enumerate(states) if T >> i & 1)
+            return dsets[T]
 
         if self.is_deterministic():
             return self
 
-        dstat = {frozenset({self.s0}): False} # Dstates (store marked/unmarked sets of states T)
+        states = list(self.S)
+        state_id = {s: i for i, s in enumerate(states)}
+        for (S, _), U in self.d.items():
+            for s in (S, *U):
+                if s not in state_id:
+                    state_id[s] = len(states)
+                    states.append(s)
+        if self.s0 not in state_id:
+            state_id[self.s0] = len(states)
+            states.append(self.s0)
+
+        # trans[a][i] is the mask of states reachable from states[i] via a
+        trans = {a: [0] * len(states) for a in self.A}
+        for (S, a), U in self.d.items():
+            if a not in trans:
+                continue
+            t = trans[a]
+            for s in U:
+                t[state_id[S]] |= 1 << state_id[s]
+        F_mask = 0
+        for s in self.F:
+            if s in state_id:
+                F_mask |= 1 << state_id[s]
+
+        T0 = 1 << state_id[self.s0]
+        seen = {T0} # Dstates
+        work = deque([T0]) # unmarked Dstates
         dtran = {} # Dtran (transition table)
-        while not all(dstat.values()):
-            T = next((k for k,v in dstat.items() if not v))
-            dstat[T] = True
-            for a in self.A:
-                U = move(T, a)
+        while work:
+            T = work.popleft()
+            for a, t in trans.items():
+                U = move(T, t)
                 if not U:
                     continue
-                if frozenset(U) not in dstat:
-                    dstat[frozenset(U)] = False
-                dtran[(T, a)] = set([frozenset(U)])
+                if U not in seen:
+                    seen.add(U)
+                    work.append(U)
+                dtran[(T, a)] = U
 
-        F = {T for T in dstat if any(s in self.F for s in T)}
-        return FA(S = set(dstat.keys()), A = self.A, s0 = frozenset({self.s0,}), d = dtran, F = F)
+        dsets = {}
+        return FA(S = {decode(T) for T in seen},
+                  A = self.A,
+                  s0 = decode(T0),
+                  d = {(decode(T), a): {decode(U)} for (T, a), U in dtran.items()},
+                  F = {decode(T) for T in seen if T & F_mask})
 
 
     def draw(self, dirname: str, name: str) -> str:
@@ -141,24 +285,24 @@ class FA:
         :param dirname: Directory in which the file will be created.
         :param name: Name of the diagram, which will become the filename.
         :returns: Full path of the exported file.'''
-        import graphviz
-        dot = graphviz.Digraph(name, format='svg')
-        dot.attr(rankdir='LR')
-
-        nonfinal_states = (str(s) for s in self.S - self.F)
-        final_states = (str(s) for s in self.F)
-        edges = [(str(k[0]), str(s), str(k[1])) for k,v in self.d.items() for s in v]
-
-        for s in final_states:
-            dot.attr('node', shape='doublecircle')
-            dot.node(s)
-
-        for s in nonfinal_states:
-            dot.attr('node', shape='circle')
-            dot.node(s)
-
-        for s0, s1, label in edges:
-            dot.edge(s0, s1, label=label)
+        if _graphviz is None:
+            raise ImportError("the graphviz package is required for FA.draw()")
+        dot = _graphviz.Digraph(name, format='svg')
+        # quote the same way as Digraph.node() and Digraph.edge() do
+        quote, quote_edge = _graphviz.quoting.quote, _graphviz.quoting.quote_edge
+
+        nonfinal_states = (quote(str(s)) for s in self.S - self.F)
+        final_states = (quote(str(s)) for s in self.F)
+        edges = ((quote_edge(str(k[0])), quote_edge(str(s)), quote(str(k[1])))
+                 for k,v in self.d.items() for s in v)
+
+        # write the DOT statements directly instead of a method call per node/edge
+        body = ['\trankdir=LR\n', '\tnode [shape=doublecircle]\n']
+        body.extend('\t{}\n'.format(s) for s in final_states)
+        body.append('\tnode [shape=circle]\n')
+        body.extend('\t{}\n'.format(s) for s in nonfinal_states)
+        body.extend('\t{} -> {} [label={}]\n'.format(s0, s1, label) for s0, s1, label in edges)
+        dot.body = body
 
         name = dot.render(directory=dirname).replace('\\', '/')
         return name
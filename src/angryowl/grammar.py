@@ -1,6 +1,9 @@
 from __future__ import annotations
 from enum import IntEnum
 from copy import deepcopy
+from itertools import chain
+import random
+from random import Random
 from typing import Generator
 from collections import defaultdict
 from collections.abc import Hashable, Iterable
@@ -27,6 +30,9 @@ class Grammar:
     The list of productions is represented by a dictionary,
     each rule being a mapping of a string of symbols onto another string of symbols.
 
+    ``VN`` and ``VT`` are copied into new sets,
+    while ``P`` is kept as given, so it is shared with the caller.
+
     For example, the following formal grammar::
 
         A -> aA
@@ -43,34 +49,53 @@ class Grammar:
                     ("B",): {("b",)}
                 },
                 S = "A")
+
+    Results derived from the rules (e.g. :meth:`type`) are cached on the object.
+    The methods of this class keep the caches up to date, but code that modifies
+    ``VN``, ``VT``, ``P`` or ``S`` directly must reset them afterwards
+    by calling :meth:`invalidate_caches`.
     '''
 
     SymbolsStr = tuple[Hashable]
 
 
     def __init__(self, VN: set[Hashable], VT: set[Hashable], P: dict[SymbolsStr, set[SymbolsStr]], S: Hashable):
-        self.VN = VN
-        self.VT = VT
+        self.VN = {automata.intern_symbol(s) for s in VN}
+        self.VT = {automata.intern_symbol(s) for s in VT}
         self.P = P
         self.S = S
+        self.invalidate_caches()
+
+
+    def invalidate_caches(self):
+        '''Drop the results cached from the rules and the nonterminals.
+        Must be called after modifying ``VN``, ``VT``, ``P`` or ``S`` directly.'''
+        self._type_cache = None
+        self._sampler = None
+        self._nullable_cache = self._null_cache = None
+        self._next_nt_id = {}
 
 
     def __repr__(self):
-        s = "{"
-        for left, right in self.production_rules():
-            s += "{} -> {}, ".format(' '.join(left), ' '.join(right))
-        s = s[:-2]
-        s += "}"
-        return s
+        rules = ', '.join(f"{' '.join(left)} -> {' '.join(right)}"
+                          for left, right in self.production_rules())
+        return f"{{{rules}}}"
 
 
     def __eq__(self, other):
 
-        if isinstance(other, Grammar):
-            return (self.VN == other.VN and
-                    self.VT == other.VT and
-                    self.S == other.S and
-                    self.P == other.P)
+        if not isinstance(other, Grammar):
+            return NotImplemented
+        # cheapest checks first
+        if self.S != other.S:
+            return False
+        if (len(self.VN) != len(other.VN) or
+            len(self.VT) != len(other.VT) or
+            len(self.P) != len(other.P)):
+            return False
+        return (self.VN == other.VN and
+                self.VT == other.VT and
+                self.P == other.P)
 
 
     def production_rules(self) -> Generator[tuple[SymbolsStr, SymbolsStr], None, None]:
@@ -86,60 +111,135 @@ class Grammar:
         If we determine the type of each production rule in the grammar,
         then the type of the grammar will be the least restrictive type among them
         (i.e. the minimum number).
+
+        The result is cached on the grammar (see the note on modifying a grammar
+        in :class:`Grammar`).
         '''
+        if self._type_cache is not None:
+            return self._type_cache
+
+        VN = frozenset(self.VN)
+        VT = frozenset(self.VT)
+
+        # checks of the strictly regular rule forms A -> ε, A -> a, A -> aB
+        # keyed by the lengths of the head and the tail
+        regular_forms = {
+            (1, 0): lambda head, tail: head[0] in VN,
+            (1, 1): lambda head, tail: head[0] in VN and tail[0] in VT,
+            (1, 2): lambda head, tail: head[0] in VN and tail[0] in VT and tail[1] in VN,
+        }
+
+        def is_regular(head: Iterable[Hashable], tail: Iterable[Hashable]) -> bool:
+            check = regular_forms.get((len(head), len(tail)))
+            return check is not None and check(head, tail)
 
         def rule_type(head: Iterable[Hashable], tail: Iterable[Hashable]) -> GrammarType:
-            if len(head) == 1 and head[0] in self.VN \
-               and (len(tail) == 0 or
-                    len(tail) == 1 and tail[0] in self.VT or
-                    len(tail) == 2 and tail[0] in self.VT and tail[1] in self.VN):
+            if is_regular(head, tail):
                 return GrammarType.REGULAR
 
-            if len(head) == 1 and head[0] in self.VN:
+            if len(head) == 1 and head[0] in VN:
                 return GrammarType.CONTEXT_FREE
 
+            hl, tl = len(head), len(tail)
+            if hl > tl:
+                # context-sensitive rules never shrink the string,
+                # no need to look at every nonterminal of the head
+                return GrammarType.UNRESTRICTED
+
+            shift = tl - hl  # offset of the right context in tail relative to head
             for i,l in enumerate(head):
                 # for every nonterminal "A" in head
-                # check if it satisfies αAβ → αγβ
-                if l not in self.VN:
+                # check if it satisfies αAβ → αγβ,
+                # comparing the contexts in place instead of slicing them
+                if l not in VN:
                     continue
-                lh = head[:i]  # left context in head
-                rh = head[i+1:]  # right context in head
-                lt = tail[:i]  # left context in tail
-                rt = tail[-len(rh):] if len(rh) != 0 else ''  # right context in tail
-
-                if lh == lt and rh == rt and len(head) <= len(tail):
+                if all(head[k] == tail[k] for k in range(i)) \
+                   and all(head[k] == tail[k + shift] for k in range(i + 1, hl)):
                     return GrammarType.CONTEXT_SENSITIVE
 
             return GrammarType.UNRESTRICTED
 
-        return min(rule_type(h, t) for h, t in self.production_rules())
-
-
-    def constr_word(self) -> list[Hashable]:
+        # fast path for the common case of a regular grammar:
+        # only the regular form of the rules has to be checked
+        for h, tails in self.P.items():
+            if not all(is_regular(h, tail) for tail in tails):
+                break
+        else:
+            self._type_cache = GrammarType.REGULAR
+            return self._type_cache
+
+        t = GrammarType.REGULAR
+        for h, tails in self.P.items():
+            for tail in tails:
+                rt = rule_type(h, tail)
+                if rt < t:
+                    t = rt
+                    if t == GrammarType.UNRESTRICTED:
+                        # nothing is less restrictive, skip the remaining rules
+                        self._type_cache = t
+                        return t
+
+        self._type_cache = t
+        return t
+
+
+    def constr_word(self, rng: Random | None = None) -> list[Hashable]:
         '''Assuming a `*strictly* regular grammar <https://en.wikipedia.org/wiki/Regular_grammar#Strictly_regular_grammars>`_,
         construct a word using rules from the grammar picked at random.
 
+        :param rng: Random number generator to pick the rules with
+            (the global one from the :mod:`random` module by default).
         :returns: A random string that is valid according to the grammar.
         '''
+        return self.constr_words(1, rng)[0]
+
+
+    def constr_words(self, n: int, rng: Random | None = None) -> list[list[Hashable]]:
+        '''Construct ``n`` random words, like calling :meth:`constr_word` ``n`` times,
+        except that the grammar is checked and prepared for sampling only once.
+
+        :param n: Number of words to construct.
+        :param rng: Random number generator to pick the rules with
+            (the global one from the :mod:`random` module by default).
+        :returns: A list of random strings that are valid according to the grammar.
+        '''
         assert self.type() == GrammarType.REGULAR
 
-        from random import choice
-        s = self.S  # current state
-        w = []  # word
+        choice = rng.choice if rng is not None else random.choice
+        tails = self._compile_sampler()
+        words = []
 
-        while True:
-            tail = choice(list(self.P[s,]))
-            if len(tail) == 2:
-                w.append(tail[0])
-                s = tail[1]
-            elif len(tail) == 1:
-                w.append(tail[0])
-                break
-            elif len(tail) == 0:
-                break
+        for _ in range(n):
+            s = self.S  # current state
+            w = []  # word
+            append = w.append
+
+            while True:
+                tail = choice(tails[s])
+                if len(tail) == 2:
+                    append(tail[0])
+                    s = tail[1]
+                elif len(tail) == 1:
+                    append(tail[0])
+                    break
+                elif len(tail) == 0:
+                    break
+
+            words.append(w)
 
-        return w
+        return words
+
+
+    def _compile_sampler(self) -> dict[Hashable, tuple[SymbolsStr]]:
+        # Map every nonterminal to a tuple of its right sides, so that a random
+        # rule can be picked without converting the set of rules on every step.
+        # The right sides are put in a fixed order (set order depends on string hashing,
+        # which changes between runs), so that seeding `random` gives reproducible words.
+        # The table is cached until the grammar is modified.
+        if self._sampler is None:
+            self._sampler = {left[0]: tuple(sorted(rights, key=repr)) for left, rights in self.P.items()
+                             if len(left) == 1}
+        return self._sampler
 
 
     def to_NFA(self) -> automata.FA:
@@ -183,36 +283,54 @@ class Grammar:
         :param g: A *strictly* regular grammar.
         :returns: An :class:`angryowl.automata.FA` instance.
         '''
-        assert self.type() == GrammarType.REGULAR
-        d = defaultdict(set)
+        VN = self.VN
+        VT = self.VT
+        d = {}
         F = set()
         A = set()
+        d_setdefault = d.setdefault
+        F_add = F.add
+        A_add = A.add
+        eps = False  # whether any rule has the form A -> a
 
+        # The grammar must be regular, which is checked rule by rule
+        # while building the NFA instead of calling self.type() beforehand
         for left, right in self.production_rules():
-            left = left[0]  # in a regular grammar, left is a single nonterminal
-            if len(right) == 0:
-                F |= {left}
-            elif len(right) == 1:
-                d[(left, right[0])] |= {"ε"}
-                F |= {"ε"}
-                A |= {right[0]}
-            elif len(right) == 2:
-                d[(left, right[0])] |= {right[1]}
-                A |= {right[0]}
-
-        d = dict(d)  # demote from defaultdict
-        return automata.FA(S = self.VN | F, A = A, s0 = self.S, d = d, F = F)
+            assert len(left) == 1 and left[0] in VN, "not a regular grammar: {} -> {}".format(left, right)
+            left = left[0]
+            n = len(right)
+            if n == 0:
+                F_add(left)
+            elif n == 1 and right[0] in VT:
+                d_setdefault((left, right[0]), set()).add(automata.EPSILON)
+                A_add(right[0])
+                eps = True
+            else:
+                assert n == 2 and right[0] in VT and right[1] in VN, \
+                    "not a regular grammar: {} -> {}".format(left, right)
+                d_setdefault((left, right[0]), set()).add(right[1])
+                A_add(right[0])
+
+        if eps:
+            F_add(automata.EPSILON)
+
+        # FA copies the states into a frozenset, so chain them instead of building the union
+        return automata.FA(S = chain(self.VN, F), A = A, s0 = self.S, d = d, F = F)
 
 
     def _new_nonterminal(self, s):
-        # Find a symbol that starts with `s` that's not used as a nonterminal
-        i = 0
+        # Find a symbol that starts with `s` that's not used as a nonterminal.
+        # The next index to try is remembered for every prefix,
+        # so generating many symbols with the same prefix doesn't probe all the used ones again.
+        # The indexes are forgotten by invalidate_caches(), so that names removed from VN
+        # can be reused.
+        i = self._next_nt_id.get(s, 0)
         while True:
             ns = "{}{}".format(s, i)
-            if ns not in self.VN:
-                break
             i += 1
-        return ns
+            if ns not in self.VN:
+                self._next_nt_id[s] = i
+                return ns
 
 
     def _START(self):
@@ -220,120 +338,206 @@ class Grammar:
         self.P[(s,)] = {(self.S,)}
         self.S = s
         self.VN |= {s}
+        self.invalidate_caches()
 
 
     def _TERM(self):
+        VT = self.VT
+
         # find all non-solitary terminals
         terminals = set()
         for left, right in self.production_rules():
             if len(right) <= 1:
                 continue
             for s in right:
-                if s in self.VT:
+                if s in VT:
                     terminals.add(s)
 
         # create new non-terminals for every such terminal
         mapping = dict()
         for s in terminals:
-            ns = self._new_nonterminal(s)
-            self.VN.add(ns)
-            self.P[(ns,)] = {(s,)}
-            mapping[s] = ns
+            self._term_nonterminal(s, mapping)
 
-        # replace all terminals with non-terminals
-        P2 = self.P.copy()
-        for left, right in self.production_rules():
-            if len(right) <= 1:
-                continue
-            r2 = ()
-            for s in right:
-                if s in self.VT:
-                    s = mapping[s]
-                r2 += s,
-            P2[left].remove(right)
-            P2[left].add(r2)
+        # replace all terminals with non-terminals,
+        # building fresh sets so that the old rules aren't modified
+        P2 = {}
+        for left, rights in self.P.items():
+            P2[left] = {tuple(mapping[s] if s in VT else s for s in right) if len(right) > 1 else right
+                        for right in rights}
+        for s, ns in mapping.items():
+            P2[(ns,)] = {(s,)}
 
         self.P = P2
+        self.invalidate_caches()
 
 
     def _BIN(self):
-        P2 = self.P.copy()
-        for left, right in self.production_rules():
-            # elliminate rules with more than 2 terminals on the right
-            if len(right) <= 2:
-                continue
+        VN = self.VN
+        P2 = {}
+        for left, rights in self.P.items():
+            new_rights = P2.setdefault(left, set())
+            for right in rights:
+                # elliminate rules with more than 2 terminals on the right
+                if len(right) <= 2:
+                    new_rights.add(right)
+                    continue
+
+                assert all(s in VN for s in right)
+                self._split(left, right, P2)
+
+        self.P = P2
+        self.invalidate_caches()
+
+
+    def _term_nonterminal(self, s, mapping):
+        # The nonterminal that replaces the terminal `s` in _TERM,
+        # created on first use and remembered in `mapping`
+        if s not in mapping:
+            mapping[s] = self._new_nonterminal(s)
+            self.VN.add(mapping[s])
+        return mapping[s]
+
+
+    def _split(self, left, right, P2):
+        # Add the rule left -> X1 X2 ... Xn (n > 2) to P2 as the chain of rules
+        # left -> X1 N1, N1 -> X2 N2, ..., Nn-2 -> Xn-1 Xn with new nonterminals Ni
+        prev = left
+        for s in right[:-2]:
+            ns = self._new_nonterminal(left[0])
+            self.VN.add(ns)
+            P2.setdefault(prev, set()).add((s, ns))
+            prev = (ns,)
+        P2[prev] = {(right[-2], right[-1])}
+
+
+    def _TERM_BIN(self):
+        # Same as _TERM followed by _BIN, but in a single pass over the rules:
+        # terminals get their nonterminals on first use and long rules are split right away.
+        # The result has the same rules up to the names of the new nonterminals,
+        # which are numbered in a different order than by the two separate passes.
+        VN = self.VN
+        VT = self.VT
+        mapping = dict()
+
+        P2 = {}
+        for left, rights in self.P.items():
+            new_rights = P2.setdefault(left, set())
+            for right in rights:
+                if len(right) <= 1:
+                    new_rights.add(right)
+                    continue
+
+                right = tuple(self._term_nonterminal(s, mapping) if s in VT else s for s in right)
+                if len(right) == 2:
+                    new_rights.add(right)
+                    continue
 
-            assert all(s in self.VN for s in right)
+                assert all(s in VN for s in right)
+                self._split(left, right, P2)
 
-            # split the current rule
-            prev_sym = left[0]
-            P2[left].remove(right)
-            for s in right[:-2]:
-                ns = self._new_nonterminal(left[0])
-                self.VN.add(ns)
-                P2[(prev_sym,)].add((s, ns))
-                P2[(ns,)] = set()
-                prev_sym = ns
-            P2[(prev_sym,)] = {(right[-2], right[-1])}
+        for s, ns in mapping.items():
+            P2[(ns,)] = {(s,)}
 
         self.P = P2
+        self.invalidate_caches()
 
 
     def _DEL(self):
-        # NOTE: currently doesn't work with recursive production rules
         def combinations(sl):
             '''Given a tuple of symbols "sl",
             returns an equivalent set of rules with inlined nullables and removed nulls'''
-            if len(sl) == 0:
-                return {()}
-            s = sl[0]
-            rest = sl[1:]
-            cs = combinations(rest)
-            if self._is_null(s):
-                return cs
+            kept = [s for s in sl if not self._is_null(s)]
+            optional = [i for i, s in enumerate(kept) if self._is_nullable(s)]
 
-            aug = {(s,) + t for t in cs}
+            # every bit of the mask says whether the corresponding nullable symbol is kept
+            cs = set()
+            for mask in range(1 << len(optional)):
+                dropped = {i for j, i in enumerate(optional) if not mask >> j & 1}
+                cs.add(tuple(s for i, s in enumerate(kept) if i not in dropped))
+            return cs
 
-            if s in self.VT or not self._is_nullable(s):
-                return aug
-            if self._is_nullable(s):
-                return cs | aug
-
-            assert False
-
-        P2 = defaultdict(set)
+        P2 = {}
         for left, right in self.production_rules():
             if len(right) == 0:
                 if left[0] == self.S:
-                    P2[left].add(right)
+                    P2.setdefault(left, set()).add(right)
                 continue
             cs = combinations(right)
             for rule in cs:
                 if len(rule) == 0:
                     continue
-                P2[left].add(rule)
-        self.P = dict(P2)
+                P2.setdefault(left, set()).add(rule)
+        self.P = P2
+        self.invalidate_caches()
 
 
     def _UNIT(self):
-        def replace():
-            replaced = False
-            P2 = defaultdict(set)
-
-            for left, right in self.production_rules():
-                if len(right) == 1 and right[0] in self.VN:
-                    replaced = True
-                    P2[left] |= self.P[right]
-                    continue
-                P2[left].add(right)
+        VN = self.VN
+        P2 = {}
+        for left in self.P:
+            # collect the non-unit rules of every nonterminal reachable from `left`
+            # through a chain of unit rules (A → B → ... → C)
+            rights = set()
+            seen = {left}
+            stack = [left]
+            while stack:
+                for right in self.P.get(stack.pop(), ()):
+                    if len(right) == 1 and right[0] in VN:
+                        if right not in seen:
+                            seen.add(right)
+                            stack.append(right)
+                    else:
+                        rights.add(right)
+            if rights:
+                P2[left] = rights
+
+        self.P = P2
+        self.invalidate_caches()
 
-            self.P = dict(P2)
-            return replaced
 
-        while True:
-            if not replace():
-                break
+    def _nullables(self):
+        '''Compute the sets of nullable and null nonterminals (see :meth:`_is_nullable`
+        and :meth:`_is_null`) by propagating along the rules, in time linear in the size of P.
+        The result is cached until the grammar is modified.'''
+        if self._nullable_cache is not None:
+            return self._nullable_cache, self._null_cache
+
+        rules = [(left[0], right) for left, right in self.production_rules() if len(left) == 1]
+        # occurs[X] lists the rules whose right side contains X (once per occurrence)
+        occurs = defaultdict(list)
+        for r, (_, right) in enumerate(rules):
+            for s in right:
+                occurs[s].append(r)
+
+        # least fixed point: a rule makes its head nullable
+        # once every symbol on its right side is known to be nullable
+        missing = [len(right) for _, right in rules]
+        work = [left for left, right in rules if len(right) == 0]
+        nullable = set()
+        while work:
+            A = work.pop()
+            if A in nullable:
+                continue
+            nullable.add(A)
+            for r in occurs[A]:
+                missing[r] -= 1
+                if missing[r] == 0:
+                    work.append(rules[r][0])
+
+        # greatest fixed point: start with every nonterminal, and whenever a symbol
+        # turns out not to be null, so do the heads of the rules that contain it
+        null = {left[0] for left in self.P if len(left) == 1} - self.VT
+        work = [left for left, right in rules if any(s not in null for s in right)]
+        while work:
+            A = work.pop()
+            if A not in null:
+                continue
+            null.discard(A)
+            for r in occurs[A]:
+                work.append(rules[r][0])
 
+        self._nullable_cache, self._null_cache = nullable, null
+        return nullable, null
 
 
     def _is_nullable(self, s):
@@ -341,16 +545,7 @@ class Grammar:
         1. A rule A → ε exists
         2. A rule A → X1 ... Xn exists, and every single Xi is nullable
         '''
-        if s in self.VT:
-            return False
-
-        assert self.P.get((s,)) != None
-        for rule_right in self.P[(s,)]:
-            if (len(self.P[(s,)]) == 0) \
-               or all(self._is_nullable(s1) for s1 in rule_right if s1 != s):
-                return True
-
-        return False
+        return s in self._nullables()[0]
 
 
     def _is_null(self, s):
@@ -358,16 +553,7 @@ class Grammar:
         1. A → ε
         2. A → B, where B is null
         '''
-        if s in self.VT:
-            return False
-
-        assert self.P.get((s,)) != None
-        for rule_right in self.P[(s,)]:
-            if not(len(rule_right) == 0
-                   or all(self._is_null(s1) for s1 in rule_right if s1 != s)):
-                return False
-
-        return True
+        return s in self._nullables()[1]
 
 
     def to_normal_form(self) -> Grammar:
@@ -379,8 +565,7 @@ class Grammar:
         g = deepcopy(self)
         # all these procedures are explained on the wikipedia page
         g._START()
-        g._TERM()
-        g._BIN()
+        g._TERM_BIN()  # _TERM and _BIN fused into one pass
         g._DEL()
         g._UNIT()
 
@@ -395,16 +580,18 @@ class Grammar:
         # We could do that using Grammar.type(),
         # but really we only need to check that the left side
         # of each rule has length 1
+        VN = self.VN
+        VT = self.VT
 
         for left, right in self.production_rules():
             # there are 3 only valid rule forms:
             # 1. S -> ε
             # 2. A -> a
             # 3. A -> BC
-            if not (len(left) == 1 and left[0] in self.VN # check that it's context-free
+            if not (len(left) == 1 and left[0] in VN # check that it's context-free
                     and ((left[0] == self.S and len(right) == 0)  # form (1)
-                         or (len(right) == 1 and right[0] in self.VT)  # form (2)
-                         or (len(right) == 2 and right[0] in self.VN and right[1] in self.VN))):  # form (3)
+                         or (len(right) == 1 and right[0] in VT)  # form (2)
+                         or (len(right) == 2 and right[0] in VN and right[1] in VN))):  # form (3)
                 return False
 
         return True
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import pytest
-from angryowl.grammar import *
-from angryowl.automata import *
-from icecream import ic
+from copy import deepcopy
+from random import Random
+from types import SimpleNamespace
+from angryowl.grammar import Grammar
+from angryowl.automata import FA
 
 '''
 The test data components are:
@@ -15,7 +17,12 @@ The test data components are:
 - DFA constructed from the previous FA, states must be represented by frozenset()
 '''
 
-tests = [
+# DFA states shared by the test data
+FA_A = frozenset(['A'])
+FA_AB = frozenset(['A', 'B'])
+FA_EPS = frozenset(['ε'])
+
+regular_tests = [
     (
         3,
         Grammar(VN = {"A", "B"},
@@ -30,16 +37,13 @@ tests = [
            d = {('A', 'a'): {'A', 'B'}, ('B', 'b'): {'ε'}},
            F = {'ε', 'A'}),
         False,
-        FA(S = {frozenset(['A']), frozenset(['A', 'B']), frozenset(['ε'])},
+        FA(S = {FA_A, FA_AB, FA_EPS},
            A = {'a', 'b'},
-           s0 = frozenset(['A']),
-           d = {(frozenset(['A']), 'a'): {frozenset(['A', 'B'])},
-                (frozenset(['A', 'B']), 'a'): {frozenset(['A', 'B'])},
-                (frozenset(['A', 'B']), 'b'): {frozenset(['ε'])}},
-           F = {frozenset(['A']),
-                frozenset(['A', 'B']),
-                frozenset(['ε'])}
-           )
+           s0 = FA_A,
+           d = {(FA_A, 'a'): {FA_AB},
+                (FA_AB, 'a'): {FA_AB},
+                (FA_AB, 'b'): {FA_EPS}},
+           F = {FA_A, FA_AB, FA_EPS})
     ),
 
     (
@@ -69,50 +73,118 @@ tests = [
     ),
 ]
 
-@pytest.mark.parametrize("t, g, wl, nfa, det, dfa", tests)
-class TestRegularGrammars:
-    def test_Grammar_type(self, g, wl, t, nfa, det, dfa):
-        assert g.type() == t
-
-    def test_Grammar_to_NFA(self, g, wl, t, nfa, det, dfa):
-        test_nfa = g.to_NFA()
-        assert nfa == test_nfa
-
-    def test_NFA_to_Grammar(self, g, wl, t, nfa, det, dfa):
-        test_g = nfa.to_grammar()
-        assert test_g == g
-
-    def test_is_deterministic(self, g, wl, t, nfa, det, dfa):
-        assert nfa.is_deterministic() == det
-
-    def test_NFA_to_DFA(self, g, wl, t, nfa, det, dfa):
-        test_dfa = nfa.to_DFA()
-        assert dfa == test_dfa
-
-    def test_DFA_verify_word(self, g, wl, t, nfa, det, dfa):
-        assert all(dfa.verify(w) for w in wl)
+# every example word of `regular_tests` with the DFA that must accept it
+regular_words = [(dfa, w) for _, _, wl, _, _, dfa in regular_tests for w in wl]
+
+@pytest.fixture(scope="session")
+def draw_dir(tmp_path_factory):
+    '''Directory for the diagrams exported by the tests.'''
+    return tmp_path_factory.mktemp("fa")
+
+@pytest.fixture(scope="session", params=regular_tests)
+def regular(request):
+    '''One test case of `regular_tests`, with the conversions computed once for all the tests.'''
+    t, g, wl, nfa, det, dfa = request.param
+    return SimpleNamespace(t=t, g=g, wl=wl, nfa=nfa, det=det, dfa=dfa,
+                           computed_type=g.type(),
+                           computed_nfa=g.to_NFA(),
+                           computed_dfa=nfa.to_DFA(),
+                           computed_grammar=nfa.to_grammar(),
+                           computed_det=nfa.is_deterministic())
 
-    def test_Grammar_constr_word(self, g, wl, t, nfa, det, dfa):
-        assert all(dfa.verify(g.constr_word()) for _ in range(100))
-
-    def test_draw(self, g, wl, t, nfa, det, dfa):
+class TestRegularGrammars:
+    def test_Grammar_type(self, regular):
+        assert regular.computed_type == regular.t
+
+    def test_Grammar_to_NFA(self, regular):
+        assert regular.nfa == regular.computed_nfa
+
+    def test_NFA_to_Grammar(self, regular):
+        assert regular.computed_grammar == regular.g
+
+    def test_is_deterministic(self, regular):
+        assert regular.computed_det == regular.det
+
+    def test_is_deterministic_after_editing_d(self, regular):
+        dfa = deepcopy(regular.dfa)
+        assert dfa.is_deterministic()
+        k = next(iter(dfa.d))
+        dfa.d[k] = set(dfa.S)
+        dfa.invalidate_caches()
+        assert not dfa.is_deterministic()
+
+    def test_is_deterministic_after_replacing_d(self, regular):
+        dfa = deepcopy(regular.dfa)
+        assert dfa.is_deterministic()
+        dfa.d = {k: set(dfa.S) for k in dfa.d}
+        assert not dfa.is_deterministic()
+
+    def test_NFA_to_DFA(self, regular):
+        assert regular.dfa == regular.computed_dfa
+
+    @pytest.mark.parametrize("dfa, w", regular_words)
+    def test_DFA_verify_word(self, dfa, w):
+        assert dfa.verify(w)
+
+    def test_DFA_verify_many(self, regular):
+        rejected = [w + ('x',) for w in map(tuple, regular.wl)]  # 'x' isn't in any alphabet
+        assert regular.dfa.verify_many(regular.wl) == [True] * len(regular.wl)
+        assert regular.dfa.verify_many(rejected) == [False] * len(regular.wl)
+
+    def test_DFA_verify_after_changing_F(self, regular):
+        dfa = deepcopy(regular.dfa)
+        assert dfa.verify(regular.wl[0])
+        dfa.F = frozenset()
+        assert not dfa.verify(regular.wl[0])
+        assert dfa.verify_many(regular.wl) == [False] * len(regular.wl)
+
+    def test_DFA_verify_after_editing_d(self, regular):
+        dfa = deepcopy(regular.dfa)
+        w = max(regular.wl, key=len)
+        assert dfa.verify(w)
+        dfa.d.clear()
+        dfa.invalidate_caches()
+        assert not dfa.verify(w)
+        assert dfa.verify_many([w]) == [False]
+
+    @pytest.mark.parametrize("seed", range(10))
+    def test_Grammar_constr_word(self, regular, seed):
+        rng = Random(seed)
+        assert all(regular.dfa.verify(regular.g.constr_word(rng)) for _ in range(10))
+
+    def test_Grammar_constr_words(self, regular):
+        words = regular.g.constr_words(100)
+        assert len(words) == 100
+        assert all(regular.dfa.verify(w) for w in words)
+
+    def test_Grammar_constr_words_seeded(self, regular):
+        assert regular.g.constr_words(20, Random(0)) == regular.g.constr_words(20, Random(0))
+
+    @pytest.mark.slow
+    def test_draw(self, regular, draw_dir, request):
         from os.path import isfile
-        assert isfile(nfa.draw('/tmp/', 'nfa'))
-        assert isfile(dfa.draw('/tmp/', 'dfa'))
-
-
-tests = [(0, Grammar(VN = {'A', 'B'},
-                     VT = {},
-                     S = "",
-                     P = {("A", "B"): {()}})),
-         # Check that context-free grammars require non-terminals in left side
-         (0, Grammar(VN = {'A'},
-                     VT = {'a'},
-                     S = "S",
-                     P = {("a"): {()}}))
-         ]
-
-@pytest.mark.parametrize("t, g", tests)
+        case = request.node.callspec.id  # a separate file name for every test case
+        assert isfile(regular.nfa.draw(str(draw_dir), 'nfa_' + case))
+        assert isfile(regular.dfa.draw(str(draw_dir), 'dfa_' + case))
+
+
+non_regular_tests = [(0, Grammar(VN = {'A', 'B'},
+                                 VT = {},
+                                 S = "",
+                                 P = {("A", "B"): {()}})),
+                     # Check that context-free grammars require non-terminals in left side
+                     (0, Grammar(VN = {'A'},
+                                 VT = {'a'},
+                                 S = "S",
+                                 P = {("a"): {()}})),
+                     # Nonterminal at the end of the head (empty right context)
+                     (1, Grammar(VN = {'A'},
+                                 VT = {'a', 'b'},
+                                 S = "A",
+                                 P = {('a', 'A'): {('a', 'b', 'b')}}))
+                     ]
+
+@pytest.mark.parametrize("t, g", non_regular_tests)
 class TestNonRegularGrammars:
     def test_grammar_type(self, t, g):
         assert g.type() == t
@@ -139,6 +211,26 @@ class TestGrammars:
     def test_producion_rules(self, g, production_rules):
         assert set(g.production_rules()) == production_rules
 
+    def test_invalidate_caches(self):
+        g = Grammar(VN = {'A'},
+                    VT = {'a'},
+                    S = 'A',
+                    P = {('A',): {('a', 'A'), ()}})
+        assert g.type() == 3
+        g.P[('A',)].add(('A', 'A'))
+        g.invalidate_caches()
+        assert g.type() == 2
+
+    def test_new_nonterminal_after_editing_VN(self):
+        g = Grammar(VN = {'A', 'A0'},
+                    VT = {'a'},
+                    S = 'A',
+                    P = {('A',): {('a',)}})
+        assert g._new_nonterminal('A') == 'A1'
+        g.VN -= {'A0'}
+        g.invalidate_caches()
+        assert g._new_nonterminal('A') == 'A0'
+
 
 class TestNormalForm:
     normal_grammar = Grammar(VN = {'S', 'A', 'B', 'C'},
@@ -274,6 +366,25 @@ class TestNormalForm:
         assert g_in == g_out
 
 
+    @pytest.mark.parametrize("g", [
+        Grammar(VN = {'A', 'B', 'C', 'D'},
+                VT = {'a', 'b'},
+                S = 'A',
+                P = {('A',): {('a', 'B', 'C', 'D'), ('a', 'B')},
+                     ('B',): {('b',), ('b', 'a')},
+                     ('C',): {('C', 'D')}}),
+    ])
+    def test_procedure_TERM_BIN(self, g):
+        g_seq = deepcopy(g)
+        g_seq._TERM()
+        g_seq._BIN()
+        g._TERM_BIN()
+        # The fused pass numbers the new nonterminals in a different order, so in general
+        # the two results are only equal up to renaming. With a single long rule per head,
+        # as in `g`, the names come out the same.
+        assert g == g_seq
+
+
     g_nullable = Grammar(VN = {'A', 'B', 'C'},
                          VT = {'b', 'd'},
                          S = 'A',
@@ -284,6 +395,8 @@ class TestNormalForm:
                               ('E',): {('C',)},  # is null because C is null
                               ('F',): {('C', 'D')},  # not nullable because D isn't null
                               ('G',): {('G',), ('C',)},  # test recursion
+                              ('H',): {('I',), ()},  # test mutual recursion
+                              ('I',): {('H',)},  # nullable and null through H
                               })
 
     @pytest.mark.parametrize("s, g, expected", [
@@ -294,6 +407,8 @@ class TestNormalForm:
         ('E', g_nullable, True),
         ('F', g_nullable, False),
         ('G', g_nullable, True),
+        ('H', g_nullable, True),
+        ('I', g_nullable, True),
     ])
     def test_nullable(self, s, g, expected):
         assert g._is_nullable(s) == expected
@@ -306,6 +421,8 @@ class TestNormalForm:
         ('E', g_nullable, True),
         ('F', g_nullable, False),
         ('G', g_nullable, True),
+        ('H', g_nullable, True),
+        ('I', g_nullable, True),
     ])
     def test_null(self, s, g, expected):
         assert g._is_null(s) == expected
@@ -353,7 +470,35 @@ class TestNormalForm:
                     S = 'A',
                     P = {('B',): {('a', 'b')},
                          ('A',): {('a', 'b')}}),
-        )
+        ),
+        (
+            # chain of unit rules
+            Grammar(VN = {'A', 'B', 'C'},
+                    VT = {'a'},
+                    S = 'A',
+                    P = {('A',): {('B',)},
+                         ('B',): {('C',)},
+                         ('C',): {('a',)}}),
+            Grammar(VN = {'A', 'B', 'C'},
+                    VT = {'a'},
+                    S = 'A',
+                    P = {('A',): {('a',)},
+                         ('B',): {('a',)},
+                         ('C',): {('a',)}}),
+        ),
+        (
+            # cycle of unit rules
+            Grammar(VN = {'A', 'B'},
+                    VT = {'a'},
+                    S = 'A',
+                    P = {('A',): {('B',)},
+                         ('B',): {('A',), ('a',)}}),
+            Grammar(VN = {'A', 'B'},
+                    VT = {'a'},
+                    S = 'A',
+                    P = {('A',): {('a',)},
+                         ('B',): {('a',)}}),
+        ),
     ])
     def test_procedure_UNIT(self, g_in, g_out):
         g_in._UNIT()